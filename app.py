@@ -1,19 +1,34 @@
 # app.py
 import os
 import nltk
+import io
 import re
+import shutil
 import json
+import multiprocessing
 import tempfile
+import threading
+import time
+import uuid
 import nltk
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
+from itertools import islice
 from flask import Flask, request, jsonify
 from docx import Document
-from bs4 import BeautifulSoup
-from PyPDF2 import PdfReader
+from selectolax.lexbor import LexborHTMLParser
+import pdf_worker
 from duckduckgo_search import ddg
 from sumy.parsers.plaintext import PlaintextParser
 from sumy.nlp.tokenizers import Tokenizer
 from sumy.summarizers.text_rank import TextRankSummarizer
+from sumy.utils import get_stop_words
 
 # ---------------- NLTK setup (ensure punkt) ----------------
 NLTK_DATA_DIR = os.environ.get("NLTK_DATA_DIR", "/opt/render/nltk_data")
@@ -22,18 +37,31 @@ if NLTK_DATA_DIR not in nltk.data.path:
     nltk.data.path.append(NLTK_DATA_DIR)
 
 # Ensure the required tokenizer resources are present (punkt and punkt_tab).
-# Try to find them; if missing, download quietly to NLTK_DATA_DIR.
-for res in ("tokenizers/punkt", "tokenizers/punkt_tab"):
-    try:
-        nltk.data.find(res)
-    except LookupError:
+# The Docker image ships them in NLTK_DATA_DIR and sets RISELESSON_NLTK_READY, so
+# this only runs (and only touches the disk) outside the image or on a first boot.
+def _ensure_nltk_data():
+    ready = True
+    for res in ("tokenizers/punkt", "tokenizers/punkt_tab"):
+        if os.path.isdir(os.path.join(NLTK_DATA_DIR, res)):
+            continue  # already unpacked in our own data dir, no need to walk nltk.data.path
         try:
-            # 'punkt_tab' is not always available via the same name in older NLTK
-            # but nltk.download accepts 'punkt_tab' per Sumy recommendation.
-            name = "punkt_tab" if res.endswith("punkt_tab") else "punkt"
-            nltk.download(name, download_dir=NLTK_DATA_DIR, quiet=True)
-        except Exception as e:
-            print(f"Failed to download NLTK resource {res}: {e}")
+            nltk.data.find(res)
+        except LookupError:
+            try:
+                # 'punkt_tab' is not always available via the same name in older NLTK
+                # but nltk.download accepts 'punkt_tab' per Sumy recommendation.
+                name = "punkt_tab" if res.endswith("punkt_tab") else "punkt"
+                if not nltk.download(name, download_dir=NLTK_DATA_DIR, quiet=True):
+                    ready = False
+            except Exception as e:
+                ready = False
+                print(f"Failed to download NLTK resource {res}: {e}")
+    return ready
+
+if not os.environ.get("RISELESSON_NLTK_READY"):
+    if _ensure_nltk_data():
+        os.environ["RISELESSON_NLTK_READY"] = "1"  # inherited by forked/spawned workers
+
 # ---------------- Config ----------------
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
@@ -46,117 +74,370 @@ TARGET_USER_ID_ENV = os.environ.get("TARGET_USER_ID")  # optional
 
 BASE_TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 
+# Web pages fetched for "Ask Bot to Find Lesson" are cached on disk (SQLite);
+# Telegram API calls never go through this session.
+HTTP_CACHE_PATH = os.environ.get("HTTP_CACHE_PATH", "http_cache.sqlite")
+HTTP_CACHE_EXPIRE = int(os.environ.get("HTTP_CACHE_EXPIRE", 86400))  # seconds
+HTTP_CACHE = requests_cache.CachedSession(
+    HTTP_CACHE_PATH,
+    backend="sqlite",
+    expire_after=HTTP_CACHE_EXPIRE,
+    allowable_methods=("GET",),
+)
+
+# All PDFium calls run in worker processes: parsing is CPU-bound and PDFium is not
+# thread-safe, so it must never be called on this process's request threads
+PDF_WORKERS = min(os.cpu_count() or 1, 4)
+PDF_POOL = {}       # "pool" -> ProcessPoolExecutor, created lazily and reused
+PDF_POOL_LOCK = threading.Lock()
+
 app = Flask(__name__)
 
 # In-memory session storage (ephemeral)
 SESS = {}           # chat_id -> {state, tmp, template_path}
 RUNTIME_TARGET = {} # runtime override for admin target
 
+# Updates are processed off the request path so the webhook answers immediately
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=6)  # web page downloads for lesson search
+# Per-chat FIFO of pending messages. A chat has an entry only while one EXECUTOR task
+# is draining it, so each chat's messages run one at a time and in arrival order.
+CHAT_QUEUES = {}    # chat_id -> deque of messages
+CHAT_QUEUES_LOCK = threading.Lock()
+FILE_CACHE = {}     # Telegram file_id -> local path of a previous download
+TEMPLATE_CACHE = {} # template path -> (mtime, .docx bytes), least recently used first
+TEMPLATE_CACHE_SIZE = 8
+TEMPLATE_CACHE_LOCK = threading.Lock()
+
+# Downloads and generated documents live in one process-wide directory; files
+# older than WORK_FILE_TTL are swept (session templates are kept while in use).
+WORK_DIR = tempfile.mkdtemp(prefix="riselesson_")
+WORK_FILE_TTL = int(os.environ.get("WORK_FILE_TTL", 3600))  # seconds
+WORK_SWEEP_INTERVAL = 600  # seconds
+
+# Keep-alive connection pool for api.telegram.org (one TLS handshake, not one per call).
+# Connection errors are retried for every method; 5xx only for idempotent ones (GET).
+TG_SESSION = requests.Session()
+TG_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False),
+))
+
+# Outgoing sends are spaced to stay under Telegram's limits (~30 msg/s overall,
+# ~1 msg/s per chat) instead of running into 429s
+TG_SEND_METHODS = ("sendMessage", "sendDocument")
+TG_GLOBAL_RATE = 25         # sends per second, all chats
+TG_CHAT_INTERVAL = 1.0      # seconds between sends to the same chat
+TG_429_RETRIES = 2
+TG_MAX_RETRY_AFTER = 30     # seconds; longer bans are not waited out in a worker
+SEND_LOCK = threading.Lock()
+SEND_SLOTS = {"global": 0.0}  # "global" / chat_id -> earliest monotonic time of next send
+
+# Reply keyboards are constant, so they are serialized once
+HI_RISE_KB_JSON = json.dumps({"keyboard":[["Upload PDF"],["Paste Text"],["Ask Bot to Find Lesson"]],"one_time_keyboard":True,"resize_keyboard":True})
+ADMIN_KB_JSON = json.dumps({"keyboard":[["Send Message to Target"],["Show Target"],["Set Target"],["Set Template Path"],["Exit Admin"]],"one_time_keyboard":True,"resize_keyboard":True})
+
 # ---------------- Telegram helpers ----------------
+def _reserve_send_slot(key, interval):
+    """Book the next free send time for `key` and sleep until it arrives."""
+    with SEND_LOCK:
+        now = time.monotonic()
+        slot = max(now, SEND_SLOTS.get(key, 0.0))
+        SEND_SLOTS[key] = slot + interval
+        if len(SEND_SLOTS) > 1000:  # forget chats that are not waiting on anything
+            for k in [k for k, t in SEND_SLOTS.items() if t < now and k != "global"]:
+                del SEND_SLOTS[k]
+    if slot > now:
+        time.sleep(slot - now)
+
+def _wait_for_send_slot(chat_id):
+    _reserve_send_slot(str(chat_id), TG_CHAT_INTERVAL)
+    _reserve_send_slot("global", 1.0 / TG_GLOBAL_RATE)
+
+def _retry_after(r):
+    try:
+        return int(r.json().get("parameters", {}).get("retry_after", 1))
+    except Exception:
+        return 1
+
+def _post_telegram(url, params=None, files=None, json_payload=None):
+    if files:
+        for v in files.values():
+            f = v[1] if isinstance(v, tuple) else v
+            if hasattr(f, "seek"):
+                f.seek(0)  # the file may have been consumed by a rate-limited attempt
+        return TG_SESSION.post(url, params=params, files=files, timeout=30)
+    if json_payload:
+        return TG_SESSION.post(url, json=json_payload, timeout=30)
+    return TG_SESSION.post(url, data=params, timeout=30)
+
 def telegram_api(method, params=None, files=None, json_payload=None):
     url = f"{BASE_TELEGRAM_URL}/{method}"
+    chat_id = (json_payload or params or {}).get("chat_id")
     try:
-        if files:
-            return requests.post(url, params=params, files=files, timeout=30)
-        if json_payload:
-            return requests.post(url, json=json_payload, timeout=30)
-        return requests.post(url, data=params, timeout=30)
+        if method in TG_SEND_METHODS and chat_id is not None:
+            _wait_for_send_slot(chat_id)
+        r = _post_telegram(url, params, files, json_payload)
+        for _ in range(TG_429_RETRIES):
+            if r.status_code != 429:
+                break
+            delay = _retry_after(r)
+            if delay > TG_MAX_RETRY_AFTER:
+                break
+            print(f"telegram_api {method} rate limited, retrying in {delay}s")
+            time.sleep(delay)
+            r = _post_telegram(url, params, files, json_payload)
     except Exception as e:
         print("telegram_api error:", e)
         raise
+    if not r.ok:
+        print(f"telegram_api {method} failed: {r.status_code} {r.text[:200]}")
+    return r
 
 def send_message(chat_id, text, reply_markup=None):
+    """reply_markup may be a dict or an already serialized JSON string."""
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
+        payload["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
     try:
         telegram_api("sendMessage", params=payload)
     except Exception as e:
         print("send_message error:", e)
 
 def download_file(file_id, dest_path):
+    cached = FILE_CACHE.get(file_id)
+    if cached and os.path.exists(cached):
+        if os.path.abspath(cached) != os.path.abspath(dest_path):
+            shutil.copy(cached, dest_path)
+        return dest_path
     r = telegram_api("getFile", params={"file_id": file_id})
     r.raise_for_status()
     data = r.json()
     file_path = data["result"]["file_path"]
     file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-    r2 = requests.get(file_url, timeout=60)
+    r2 = TG_SESSION.get(file_url, timeout=60)
     r2.raise_for_status()
     with open(dest_path, "wb") as f:
         f.write(r2.content)
+    FILE_CACHE[file_id] = dest_path
     return dest_path
 
+# ---------------- Work directory helpers ----------------
+def work_path(fname):
+    """Unique path inside WORK_DIR that keeps the original file name readable."""
+    return os.path.join(WORK_DIR, f"{uuid.uuid4().hex}_{os.path.basename(fname)}")
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def sweep_work_dir(max_age=WORK_FILE_TTL):
+    in_use = {s.get("template_path") for s in list(SESS.values())}
+    cutoff = time.time() - max_age
+    for name in os.listdir(WORK_DIR):
+        path = os.path.join(WORK_DIR, name)
+        try:
+            if path not in in_use and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            continue
+    for file_id, path in list(FILE_CACHE.items()):
+        if not os.path.exists(path):
+            FILE_CACHE.pop(file_id, None)
+    with TEMPLATE_CACHE_LOCK:
+        for path in [p for p in TEMPLATE_CACHE if not os.path.exists(p)]:
+            del TEMPLATE_CACHE[path]
+
+def _sweep_work_dir_forever():
+    while True:
+        time.sleep(WORK_SWEEP_INTERVAL)
+        try:
+            sweep_work_dir()
+        except Exception as e:
+            print("work dir sweep error:", e)
+
+threading.Thread(target=_sweep_work_dir_forever, name="work-dir-sweeper", daemon=True).start()
+
 # ---------------- Extraction helpers ----------------
-def extract_text_from_pdf(path):
-    """Extract plain text from PDF using PyPDF2 (best-effort)."""
-    text_parts = []
+def _get_pdf_pool():
+    with PDF_POOL_LOCK:
+        pool = PDF_POOL.get("pool")
+        if pool is None:
+            # this process runs many threads, so workers come from a forkserver
+            # that has only imported pdf_worker rather than from a plain fork()
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["pdf_worker"])
+            pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=ctx)
+            PDF_POOL["pool"] = pool
+        return pool
+
+def _drop_pdf_pool(pool):
+    with PDF_POOL_LOCK:
+        if PDF_POOL.get("pool") is pool:
+            del PDF_POOL["pool"]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _pdf_pool_map(fn, items):
+    """pool.map that replaces a broken pool (a worker died) and retries once."""
+    for attempt in (1, 2):
+        pool = _get_pdf_pool()
+        try:
+            return list(pool.map(fn, items))
+        except BrokenProcessPool:
+            print("PDF worker pool broken, recreating it")
+            _drop_pdf_pool(pool)
+            if attempt == 2:
+                raise
+
+def extract_text_from_pdf(path, max_chars=40000):
+    """
+    Extract plain text from PDF using PDFium (best-effort), pages in parallel.
+    Pages are processed in order, one batch per pool round, and extraction stops
+    once max_chars characters are collected (TextRank needs no more than that).
+    """
     try:
-        reader = PdfReader(path)
-        for page in reader.pages:
-            try:
-                t = page.extract_text()
-                if t:
-                    text_parts.append(t)
-            except Exception:
-                continue
+        n = _pdf_pool_map(pdf_worker.page_count, [path])[0]
     except Exception as e:
         print("PDF read error:", e)
         raise
+    batch = PDF_WORKERS
+    text_parts = []
+    total = 0
+    for first in range(0, n, batch):
+        idxs = range(first, min(first + batch, n))
+        pages = _pdf_pool_map(partial(pdf_worker.extract_page, path), idxs)
+        for t in pages:
+            if t:
+                text_parts.append(t)
+                total += len(t)
+        if max_chars and total >= max_chars:
+            break
     return "\n".join(text_parts)
 
-def extract_text_from_url(url, max_chars=20000):
-    """Lightweight extractor: prefer <article>, otherwise join large <p> blocks."""
+def fetch_html(url):
+    """Fetch a page and return its HTML ("" on failure)."""
     try:
-        r = requests.get(url, timeout=15, headers={"User-Agent": "Mozilla/5.0"})
+        r = HTTP_CACHE.get(url, timeout=15, headers={"User-Agent": "Mozilla/5.0"})
         r.raise_for_status()
     except Exception as e:
         print("fetch error for", url, ":", e)
         return ""
-    soup = BeautifulSoup(r.text, "html.parser")
-    article = soup.find("article")
+    return r.text
+
+def extract_text_from_html(html, max_chars=20000):
+    """Lightweight extractor: prefer <article>, otherwise join large <p> blocks."""
+    if not html:
+        return ""
+    tree = LexborHTMLParser(html)
+    article = tree.css_first("article")
     if article:
-        text = article.get_text(separator="\n")
+        text = article.text(separator="\n")
     else:
-        ps = soup.find_all("p")
-        filtered = []
-        for p in ps:
-            t = p.get_text(strip=True)
-            if not t:
-                continue
-            if len(t) < 30:  # skip very short fragments
-                continue
-            filtered.append(t)
-        text = "\n\n".join(filtered)
+        # each <p> is stringified once; very short fragments are skipped
+        paragraphs = (p.text(strip=True) for p in tree.css("p"))
+        text = "\n\n".join(t for t in paragraphs if len(t) >= 30)
     if not text or len(text.strip()) < 100:
-        title = soup.title.string.strip() if soup.title and soup.title.string else ""
-        desc_tag = soup.find("meta", attrs={"name":"description"}) or soup.find("meta", attrs={"property":"og:description"})
-        meta = desc_tag.get("content").strip() if desc_tag and desc_tag.get("content") else ""
+        title_tag = tree.css_first("title")
+        title = title_tag.text().strip() if title_tag else ""
+        desc_tag = tree.css_first('meta[name="description"]') or tree.css_first('meta[property="og:description"]')
+        meta = (desc_tag.attributes.get("content") or "").strip() if desc_tag else ""
         text = (title + "\n" + meta).strip()
     return (text or "")[:max_chars]
 
+def extract_text_from_url(url, max_chars=20000):
+    return extract_text_from_html(fetch_html(url), max_chars=max_chars)
+
+def search_lesson_pages(query, max_results=5, max_pages=3):
+    """
+    Search the web and extract text from the top hits.
+    All top-hit pages are fetched at once and each is parsed as soon as its
+    download finishes. Returns (hits, texts, references).
+    """
+    try:
+        hits = ddg(query, max_results=max_results) or []
+    except Exception as e:
+        print("ddg error:", e)
+        hits = []
+    top_hits = hits[:max_pages]
+    urls = [h.get("href") or h.get("url") for h in top_hits]
+    # hits without a URL fall back to their snippet
+    texts = [h.get("body") or h.get("snippet") or "" for h in top_hits]
+    futures = {FETCH_EXECUTOR.submit(fetch_html, url): i for i, url in enumerate(urls) if url}
+    for fut in as_completed(futures):
+        texts[futures[fut]] = extract_text_from_html(fut.result())
+    references = [f"{h.get('title') or url} — {url}" for h, url in zip(top_hits, urls)]
+    return hits, [t for t in texts if t], references
+
 # ---------------- Summarization and heuristics ----------------
+# TextRank only reads its settings while scoring, so one instance serves all threads
+SUMMARIZER = TextRankSummarizer()
+SUMMARIZER.stop_words = get_stop_words("english")
+
+@lru_cache(maxsize=1)
+def _english_tokenizer():
+    """sumy's English tokenizer (NLTK Punkt model), loaded once and shared."""
+    return Tokenizer("english")
+
+@lru_cache(maxsize=64)
+def _rank_sentences(text):
+    """
+    Run TextRank once per text and return (position, sentence) pairs, best first.
+    Summaries of any length are then just a slice of this list.
+    """
+    parser = PlaintextParser.from_string(text, _english_tokenizer())
+    sentences = parser.document.sentences
+    if not sentences:
+        return ()
+    ratings = SUMMARIZER.rate_sentences(parser.document)
+    order = sorted(range(len(sentences)), key=lambda i: ratings[sentences[i]], reverse=True)
+    return tuple((i, str(sentences[i])) for i in order)
+
 def summarize_text(text, sentences_count=6):
     if not text:
         return ""
     try:
-        parser = PlaintextParser.from_string(text, Tokenizer("english"))
-        summarizer = TextRankSummarizer()
-        summary_sentences = summarizer(parser.document, sentences_count)
-        return "\n".join(str(s) for s in summary_sentences)
+        # top-ranked sentences, restored to document order (same as TextRankSummarizer)
+        best = sorted(_rank_sentences(text)[:sentences_count])
+        return "\n".join(s for _, s in best)
     except Exception as e:
         print("summarize_text error:", e)
         lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
         return "\n".join(lines[:sentences_count]) if lines else (text[:1000] if text else "")
 
-def extract_objectives_from_text(text, max_points=5):
+# objective cue words (substring match, like the original `k in sentence` test)
+OBJECTIVE_RE = re.compile(r"able to|will|understand|learn|identify|describe", re.I)
+
+def _objective_sentences_by_period(text, max_points):
+    """Fallback when Punkt is unavailable: sentences are delimited by "."."""
     candidates = []
-    for sent in (text or "").split("."):
-        s = sent.strip()
-        if not s:
-            continue
-        sl = s.lower()
-        if any(k in sl for k in ("able to", "will", "understand", "learn", "identify", "describe", "students will")):
-            candidates.append(s.strip())
+    end = -1
+    # one regex pass over the whole text; expand each hit to its enclosing "." sentence
+    for m in OBJECTIVE_RE.finditer(text):
+        if m.start() < end:
+            continue  # another cue in a sentence we already took
+        start = text.rfind(".", 0, m.start()) + 1
+        end = text.find(".", m.end())
+        if end == -1:
+            end = len(text)
+        s = text[start:end].strip()
+        if s:
+            candidates.append(s)
+            if len(candidates) >= max_points:
+                break
+    return candidates
+
+def extract_objectives_from_text(text, max_points=5):
+    text = text or ""
+    try:
+        sentences = _english_tokenizer().to_sentences(text)
+    except LookupError as e:
+        print("sentence tokenizer unavailable:", e)
+        candidates = _objective_sentences_by_period(text, max_points)
+    else:
+        candidates = list(islice((s for s in sentences if s and OBJECTIVE_RE.search(s)), max_points))
     if candidates:
         return "\n".join(f"• {c}" for c in candidates[:max_points])
     summ = summarize_text(text, sentences_count=max_points)
@@ -207,71 +488,86 @@ def _set_paragraph_text(paragraph, new_text):
     else:
         paragraph.add_run(new_text)
 
-def _replace_in_paragraph_by_label(paragraph, label, replacement):
-    ptext = paragraph.text or ""
-    lower = ptext.lower()
-    lab = label.lower()
-    if lab not in lower:
-        return False
+def _label_replacement_text(ptext, replacement):
     # bracketed placeholder
     bracket_match = re.search(r'\[([^\]]*)\]', ptext)
     if bracket_match:
-        new_ptext = re.sub(r'\[([^\]]*)\]', replacement, ptext, count=1)
-        _set_paragraph_text(paragraph, new_ptext)
-        return True
+        return re.sub(r'\[([^\]]*)\]', replacement, ptext, count=1)
     # colon present -> replace after colon
     if ':' in ptext:
         parts = ptext.split(':', 1)
         left = parts[0].rstrip()
-        new_ptext = f"{left}: {replacement}"
-        _set_paragraph_text(paragraph, new_ptext)
-        return True
+        return f"{left}: {replacement}"
     # fallback -> overwrite paragraph
-    _set_paragraph_text(paragraph, replacement)
-    return True
-
-def _replace_in_table(table, label, replacement):
-    done = False
-    for row in table.rows:
-        for cell in row.cells:
-            for p in cell.paragraphs:
-                if _replace_in_paragraph_by_label(p, label, replacement):
-                    done = True
-    return done
-
-def _replace_in_headers_footers(doc, label, replacement):
-    done = False
+    return replacement
+
+def _table_paragraphs(table):
+    return [p for row in table.rows for cell in row.cells for p in cell.paragraphs]
+
+def _collect_paragraph_groups(doc):
+    """
+    Walk the document once and return its paragraphs grouped in label-search order:
+    each body paragraph on its own, then one group per table, then all headers/footers.
+    A label is replaced in every matching paragraph of the first group that matches.
+    """
+    groups = [[p] for p in doc.paragraphs]
+    for t in doc.tables:
+        groups.append(_table_paragraphs(t))
+    hf = []
     try:
         for section in doc.sections:
-            hdr = section.header
-            for p in hdr.paragraphs:
-                if _replace_in_paragraph_by_label(p, label, replacement):
-                    done = True
-            for t in hdr.tables:
-                if _replace_in_table(t, label, replacement):
-                    done = True
-            ftr = section.footer
-            for p in ftr.paragraphs:
-                if _replace_in_paragraph_by_label(p, label, replacement):
-                    done = True
-            for t in ftr.tables:
-                if _replace_in_table(t, label, replacement):
-                    done = True
+            for part in (section.header, section.footer):
+                hf.extend(part.paragraphs)
+                for t in part.tables:
+                    hf.extend(_table_paragraphs(t))
     except Exception:
         pass
-    return done
+    groups.append(hf)
+    return groups
 
-def _replace_in_doc(doc, label, replacement):
-    for p in doc.paragraphs:
-        if _replace_in_paragraph_by_label(p, label, replacement):
-            return True
-    for t in doc.tables:
-        if _replace_in_table(t, label, replacement):
+def _paragraph_text(paragraph, texts):
+    """Paragraph text, read from the document once and then served from `texts`."""
+    key = paragraph._p
+    if key not in texts:
+        ptext = paragraph.text or ""
+        texts[key] = (ptext, ptext.lower())
+    return texts[key]
+
+def _replace_in_doc(groups, texts, label, replacement):
+    lab = label.lower()
+    for group in groups:
+        done = False
+        for p in group:
+            ptext, lower = _paragraph_text(p, texts)
+            if lab not in lower:
+                continue
+            new_ptext = _label_replacement_text(ptext, replacement)
+            _set_paragraph_text(p, new_ptext)
+            texts[p._p] = (new_ptext, new_ptext.lower())
+            done = True
+        if done:
             return True
-    if _replace_in_headers_footers(doc, label, replacement):
-        return True
     return False
 
+def _load_template(template_path):
+    """
+    Open the template, keeping its bytes in memory until the file changes.
+    Only the TEMPLATE_CACHE_SIZE most recently used templates are kept.
+    """
+    mtime = os.path.getmtime(template_path)
+    with TEMPLATE_CACHE_LOCK:
+        cached = TEMPLATE_CACHE.pop(template_path, None)
+        if cached is not None and cached[0] == mtime:
+            TEMPLATE_CACHE[template_path] = cached  # re-insert as most recent
+    if cached is None or cached[0] != mtime:
+        with open(template_path, "rb") as f:
+            cached = (mtime, f.read())
+        with TEMPLATE_CACHE_LOCK:
+            TEMPLATE_CACHE[template_path] = cached
+            while len(TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE:
+                del TEMPLATE_CACHE[next(iter(TEMPLATE_CACHE))]
+    return Document(io.BytesIO(cached[1]))
+
 # ---------------- Main fill function for your template ----------------
 def fill_template_and_send_bracketed(chat_id, mapping):
     """
@@ -284,8 +580,10 @@ def fill_template_and_send_bracketed(chat_id, mapping):
         send_message(chat_id, "Template not found on server. Please upload a .docx template or set DEFAULT_TEMPLATE_PATH.")
         return
 
-    # load document
-    doc = Document(template_path)
+    # load document and index its paragraphs once
+    doc = _load_template(template_path)
+    groups = _collect_paragraph_groups(doc)
+    texts = {}
 
     # label variants dictionary (tune to your template's wording if needed)
     label_variants = {
@@ -309,7 +607,7 @@ def fill_template_and_send_bracketed(chat_id, mapping):
             continue
         replacement_text = mapping.get(canonical_key) or ""
         for var in variants:
-            if _replace_in_doc(doc, var, replacement_text):
+            if _replace_in_doc(groups, texts, var, replacement_text):
                 break
 
     # fallback: replace any remaining bracket tokens with leftover mapping values
@@ -319,22 +617,25 @@ def fill_template_and_send_bracketed(chat_id, mapping):
         for p in doc.paragraphs:
             def repl_fn(m):
                 return leftover_values.pop(0) if leftover_values else m.group(0)
-            new_text = bracket_pattern.sub(repl_fn, p.text)
-            if new_text != p.text:
+            ptext = _paragraph_text(p, texts)[0]
+            new_text = bracket_pattern.sub(repl_fn, ptext)
+            if new_text != ptext:
                 _set_paragraph_text(p, new_text)
 
     # save and send
-    out_tmp = tempfile.NamedTemporaryFile(suffix=".docx", delete=False)
-    out_path = out_tmp.name
+    out_path = work_path("lesson_plan.docx")
     doc.save(out_path)
     try:
         with open(out_path, "rb") as f:
-            files = {"document": (os.path.basename(out_path), f)}
-            telegram_api("sendDocument", params={"chat_id": chat_id}, files=files)
-        send_message(chat_id, "Lesson plan generated ✅")
+            files = {"document": ("lesson_plan.docx", f)}
+            r = telegram_api("sendDocument", params={"chat_id": chat_id, "caption": "Lesson plan generated ✅"}, files=files)
+        if not r.ok:
+            send_message(chat_id, "Failed to send generated file. Please try again.")
     except Exception as e:
         print("sendDocument error:", e)
         send_message(chat_id, f"Failed to send generated file: {e}")
+    finally:
+        remove_quietly(out_path)
 
 # ---------------- Admin helpers ----------------
 def is_admin(chat_id):
@@ -365,7 +666,32 @@ def webhook():
     if "message" not in update:
         return jsonify({"ok": True})
     msg = update["message"]
-    chat_id = msg["chat"]["id"]
+    _enqueue_message(msg["chat"]["id"], msg)
+    return jsonify({"ok": True})
+
+def _enqueue_message(chat_id, msg):
+    with CHAT_QUEUES_LOCK:
+        queue = CHAT_QUEUES.get(chat_id)
+        if queue is not None:
+            queue.append(msg)  # the running drain task will pick it up
+            return
+        CHAT_QUEUES[chat_id] = deque([msg])
+    EXECUTOR.submit(_drain_chat, chat_id)
+
+def _drain_chat(chat_id):
+    while True:
+        with CHAT_QUEUES_LOCK:
+            queue = CHAT_QUEUES[chat_id]
+            if not queue:
+                del CHAT_QUEUES[chat_id]
+                return
+            msg = queue.popleft()
+        try:
+            _handle_message(msg, chat_id)
+        except Exception as e:
+            print("update handling error:", repr(e))
+
+def _handle_message(msg, chat_id):
     SESS.setdefault(chat_id, {"state": "idle", "tmp": {}, "template_path": None})
 
     # ---------- Quick admin CLI commands (text-based) ----------
@@ -375,50 +701,49 @@ def webhook():
         if text.startswith("/admin"):
             if not is_admin(chat_id):
                 send_message(chat_id, "Unauthorized. Only admin can use this command.")
-                return jsonify({"ok": True})
-            kb = {"keyboard":[["Send Message to Target"],["Show Target"],["Set Target"],["Set Template Path"],["Exit Admin"]],"one_time_keyboard":True,"resize_keyboard":True}
-            send_message(chat_id, "Admin menu — choose an action:", reply_markup=kb)
+                return
+            send_message(chat_id, "Admin menu — choose an action:", reply_markup=ADMIN_KB_JSON)
             SESS[chat_id]["state"] = "admin_menu"
-            return jsonify({"ok": True})
+            return
 
         # /settarget <id>
         if text.startswith("/settarget"):
             if not is_admin(chat_id):
                 send_message(chat_id, "Unauthorized.")
-                return jsonify({"ok": True})
+                return
             parts = text.split(maxsplit=1)
             if len(parts) == 2 and parts[1].strip().isdigit():
                 RUNTIME_TARGET["target"] = parts[1].strip()
                 send_message(chat_id, f"Runtime target set to: {RUNTIME_TARGET['target']}")
             else:
                 send_message(chat_id, "Usage: /settarget <chat_id>")
-            return jsonify({"ok": True})
+            return
 
         # /showtarget
         if text.startswith("/showtarget"):
             if not is_admin(chat_id):
                 send_message(chat_id, "Unauthorized.")
-                return jsonify({"ok": True})
+                return
             cur = get_current_target()
             send_message(chat_id, f"Current target: {cur or 'None'}")
-            return jsonify({"ok": True})
+            return
 
         # /sendtarget <message>
         if text.startswith("/sendtarget"):
             if not is_admin(chat_id):
                 send_message(chat_id, "Unauthorized.")
-                return jsonify({"ok": True})
+                return
             parts = text.split(maxsplit=1)
             if len(parts) != 2:
                 send_message(chat_id, "Usage: /sendtarget <message>")
-                return jsonify({"ok": True})
+                return
             target = get_current_target()
             if not target:
                 send_message(chat_id, "No target set. Use /settarget or set TARGET_USER_ID env var.")
-                return jsonify({"ok": True})
+                return
             send_message(target, parts[1].strip())
             send_message(chat_id, f"Message sent to {target}")
-            return jsonify({"ok": True})
+            return
 
     # ---------- Admin menu handling ----------
     if "text" in msg and SESS[chat_id].get("state") == "admin_menu" and is_admin(chat_id):
@@ -426,27 +751,27 @@ def webhook():
         if choice == "Send Message to Target":
             send_message(chat_id, "Please send the message you want to forward to the target (single message).")
             SESS[chat_id]["state"] = "admin_send_message"
-            return jsonify({"ok": True})
+            return
         if choice == "Show Target":
             cur = get_current_target()
             send_message(chat_id, f"Current target: {cur or 'None'}")
             SESS[chat_id]["state"] = "admin_menu"
-            return jsonify({"ok": True})
+            return
         if choice == "Set Target":
             send_message(chat_id, "Send the chat_id to set as runtime target (digits only).")
             SESS[chat_id]["state"] = "admin_set_target"
-            return jsonify({"ok": True})
+            return
         if choice == "Set Template Path":
             send_message(chat_id, "Send the absolute path (inside container) to set as default template for admin (e.g. ./Sample Lesson Plan.docx).")
             SESS[chat_id]["state"] = "admin_set_template"
-            return jsonify({"ok": True})
+            return
         if choice == "Exit Admin":
             send_message(chat_id, "Exiting admin menu.")
             SESS[chat_id]["state"] = "idle"
-            return jsonify({"ok": True})
+            return
         send_message(chat_id, "Unknown admin choice.")
         SESS[chat_id]["state"] = "idle"
-        return jsonify({"ok": True})
+        return
 
     # ---------- Admin follow-ups ----------
     if "text" in msg and is_admin(chat_id):
@@ -457,11 +782,11 @@ def webhook():
             if not target:
                 send_message(chat_id, "No target set. Use Set Target option or /settarget <chat_id>.")
                 SESS[chat_id]["state"] = "admin_menu"
-                return jsonify({"ok": True})
+                return
             send_message(target, message_to_send)
             send_message(chat_id, f"Message sent to {target}")
             SESS[chat_id]["state"] = "admin_menu"
-            return jsonify({"ok": True})
+            return
         if state == "admin_set_target":
             cand = msg["text"].strip()
             if cand.isdigit():
@@ -470,7 +795,7 @@ def webhook():
             else:
                 send_message(chat_id, "Invalid chat_id. Digits only.")
             SESS[chat_id]["state"] = "admin_menu"
-            return jsonify({"ok": True})
+            return
         if state == "admin_set_template":
             cand = msg["text"].strip()
             if os.path.exists(cand):
@@ -479,18 +804,17 @@ def webhook():
             else:
                 send_message(chat_id, f"Path does not exist in container: {cand}")
             SESS[chat_id]["state"] = "admin_menu"
-            return jsonify({"ok": True})
+            return
 
     # ---------- Normal user flows ----------
     SESS.setdefault(chat_id, {"state": "idle", "tmp": {}, "template_path": None})
 
     # entry command /hi_rise
     if "text" in msg and msg["text"].strip().lower() == "/hi_rise":
-        kb = {"keyboard":[["Upload PDF"],["Paste Text"],["Ask Bot to Find Lesson"]],"one_time_keyboard":True,"resize_keyboard":True}
-        send_message(chat_id, "Hi! For which lesson shall we create a lesson plan today? Choose how you'd like to provide the lesson:", reply_markup=kb)
+        send_message(chat_id, "Hi! For which lesson shall we create a lesson plan today? Choose how you'd like to provide the lesson:", reply_markup=HI_RISE_KB_JSON)
         SESS[chat_id]["state"] = "idle"
         SESS[chat_id]["tmp"] = {}
-        return jsonify({"ok": True})
+        return
 
     # user options when idle
     if "text" in msg and SESS[chat_id]["state"] == "idle":
@@ -498,41 +822,41 @@ def webhook():
         if txt == "Upload PDF":
             SESS[chat_id]["state"] = "await_pdf"
             send_message(chat_id, "Please upload the lesson PDF as a document now (attach as Telegram Document).")
-            return jsonify({"ok": True})
+            return
         if txt == "Paste Text":
             SESS[chat_id]["state"] = "await_text"
             send_message(chat_id, "Please paste the chapter text now.")
-            return jsonify({"ok": True})
+            return
         if txt == "Ask Bot to Find Lesson":
             SESS[chat_id]["state"] = "await_grade"
             send_message(chat_id, "Okay — which Grade? (e.g., Grade 6)")
-            return jsonify({"ok": True})
+            return
         if len(txt) > 120:
             send_message(chat_id, "I detected pasted text — reply 'Yes' to confirm generation.")
             SESS[chat_id]["state"] = "confirm_from_text"
             SESS[chat_id]["tmp"]["text_candidate"] = txt
-            return jsonify({"ok": True})
+            return
 
     # handle document uploads (PDFs or .docx template)
     if "document" in msg:
         doc = msg["document"]
         fname = doc.get("file_name", "file")
         file_id = doc["file_id"]
-        tmpdir = tempfile.mkdtemp()
-        local_path = os.path.join(tmpdir, fname)
+        local_path = work_path(fname)
         try:
             download_file(file_id, local_path)
         except Exception as e:
+            remove_quietly(local_path)
             send_message(chat_id, f"Failed to download file: {e}")
             SESS[chat_id]["state"] = "idle"
-            return jsonify({"ok": True})
+            return
 
         # .docx -> template
         if fname.lower().endswith(".docx"):
             SESS[chat_id]["template_path"] = local_path
             send_message(chat_id, "Template uploaded and saved for your session. Now upload PDF, paste text, or use /hi_rise to start again.")
             SESS[chat_id]["state"] = "idle"
-            return jsonify({"ok": True})
+            return
 
         # pdf handling when awaiting pdf
         if fname.lower().endswith(".pdf") and SESS[chat_id]["state"] == "await_pdf":
@@ -541,7 +865,7 @@ def webhook():
             except Exception as e:
                 send_message(chat_id, f"PDF extraction failed: {e}")
                 SESS[chat_id]["state"] = "idle"
-                return jsonify({"ok": True})
+                return
 
             send_message(chat_id, "PDF received. Generating lesson plan...")
             # extract fields
@@ -572,16 +896,16 @@ def webhook():
             }
             fill_template_and_send_bracketed(chat_id, mapping)
             SESS[chat_id]["state"] = "idle"
-            return jsonify({"ok": True})
+            return
 
         send_message(chat_id, "Document received. If this is a PDF for lesson content, please choose 'Upload PDF' first. If this is a .docx template, it has been saved.")
         SESS[chat_id]["state"] = "idle"
-        return jsonify({"ok": True})
+        return
 
     # photos (OCR not enabled)
     if "photo" in msg:
         send_message(chat_id, "Photo received. OCR is not enabled in this deployment. Please upload a PDF or paste text.")
-        return jsonify({"ok": True})
+        return
 
     # plain text during flows
     if "text" in msg:
@@ -617,11 +941,11 @@ def webhook():
                     "note": note
                 }
                 fill_template_and_send_bracketed(chat_id, mapping)
-                return jsonify({"ok": True})
+                return
             else:
                 SESS[chat_id]["state"] = "idle"
                 send_message(chat_id, "Cancelled. Send /hi_rise to begin again.")
-                return jsonify({"ok": True})
+                return
 
         if state == "await_text":
             text = txt
@@ -651,20 +975,20 @@ def webhook():
                 "note": note
             }
             fill_template_and_send_bracketed(chat_id, mapping)
-            return jsonify({"ok": True})
+            return
 
         # Ask-bot-to-find flow: grade -> subject -> chapter
         if state == "await_grade":
             SESS[chat_id]["tmp"] = {"grade": txt}
             SESS[chat_id]["state"] = "await_subject"
             send_message(chat_id, "Which Subject? (e.g., Mathematics, Science, English)")
-            return jsonify({"ok": True})
+            return
 
         if state == "await_subject":
             SESS[chat_id]["tmp"]["subject"] = txt
             SESS[chat_id]["state"] = "await_chapter"
             send_message(chat_id, "Which Chapter name or number should I search for?")
-            return jsonify({"ok": True})
+            return
 
         if state == "await_chapter":
             SESS[chat_id]["tmp"]["chapter"] = txt
@@ -674,21 +998,7 @@ def webhook():
             query = f"{grade} {subject} {chapter} summary lesson"
             send_message(chat_id, f"Searching web for: {query}")
             SESS[chat_id]["state"] = "idle"
-            try:
-                hits = ddg(query, max_results=5) or []
-            except Exception as e:
-                print("ddg error:", e)
-                hits = []
-            combined_texts = []
-            references = []
-            for h in hits[:3]:
-                url = h.get("href") or h.get("url")
-                title = h.get("title") or url
-                snippet = h.get("body") or h.get("snippet") or ""
-                txt_extracted = extract_text_from_url(url) if url else snippet
-                if txt_extracted:
-                    combined_texts.append(txt_extracted)
-                references.append(f"{title} — {url}")
+            hits, combined_texts, references = search_lesson_pages(query)
             big_text = "\n\n".join(combined_texts) or " ".join([h.get("body","") or h.get("snippet","") for h in hits]) or chapter
             summary = summarize_text(big_text, sentences_count=6)
             objectives = extract_objectives_from_text(big_text)
@@ -714,14 +1024,12 @@ def webhook():
                 "note": note
             }
             fill_template_and_send_bracketed(chat_id, mapping)
-            return jsonify({"ok": True})
+            return
 
         # fallback help
         send_message(chat_id, "Send /hi_rise to start the lesson-plan flow, or upload a .docx template.")
-        return jsonify({"ok": True})
-
-    return jsonify({"ok": True})
+        return
 
-# ---------------- run app locally ----------------
+# ---------------- run app locally (production: gunicorn -c gunicorn_conf.py app:app) ----------------
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=PORT)
@@ -0,0 +1,17 @@
+# gunicorn_conf.py
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# gthread worker: real OS threads, so the CPU-bound work running on the app's
+# EXECUTOR (TextRank, .docx filling, HTML parsing) never stops the worker from
+# accepting webhooks the way a gevent hub would. Telegram calls, page fetches and
+# searches release the GIL while waiting on sockets.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Conversation state (SESS) lives in process memory, so all updates must reach the
+# same process: scale with threads, not workers.
+workers = 1
+
+timeout = 120
@@ -0,0 +1,29 @@
+# pdf_worker.py
+# Runs inside the PDF process pool. Kept free of import-time side effects (no
+# Flask app, no config, no threads) so forkserver workers only load PDFium.
+import pypdfium2 as pdfium
+
+def page_count(path):
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def extract_page(path, idx):
+    """Extract the text of a single PDF page with PDFium ("" on failure)."""
+    try:
+        pdf = pdfium.PdfDocument(path)
+    except Exception:
+        return ""
+    try:
+        page = pdf[idx]
+        textpage = page.get_textpage()
+        text = textpage.get_text_bounded()
+        textpage.close()
+        page.close()
+        return text or ""
+    except Exception:
+        return ""
+    finally:
+        pdf.close()